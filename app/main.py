@@ -1,19 +1,32 @@
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import HTMLResponse
-from datetime import date, datetime, timezone, timedelta
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import HTMLResponse, ORJSONResponse
+from datetime import date, datetime, time, timezone, timedelta
 from typing import Optional
-import random
 import os
-from fastapi import Request
+import logging
+import queue
+from logging.handlers import QueueHandler, QueueListener
+from fastapi import Request, Response
 from fastapi.responses import RedirectResponse
-from supabase import create_client
+from supabase import AsyncClient, acreate_client
 from dotenv import load_dotenv
 from fastapi import Query
 from typing import List, Dict, Optional
 import httpx
-from fastapi import Header
-from fastapi import Path
+import asyncpg
+import asyncio
+import hashlib
+from email.utils import format_datetime, parsedate_to_datetime
+from fastapi import BackgroundTasks, Header
+from fastapi import Depends, Path
+from cachetools import LRUCache, TLRUCache
+from contextlib import asynccontextmanager
+from slowapi import Limiter, _rate_limit_exceeded_handler
+from slowapi.errors import RateLimitExceeded
+from slowapi.util import get_remote_address
+from tenacity import retry, retry_if_exception_type, retry_if_result, stop_after_attempt, wait_exponential
 
 load_dotenv()
 
@@ -22,15 +35,89 @@ SUPABASE_KEY = os.getenv("SUPABASE_KEY")
 
 SUPABASE_BUCKET_URL = os.getenv("SUPABASE_BUCKET_URL")
 BUTTONDOWN_API_KEY = os.getenv("BUTTONDOWN_API_KEY")
+PG_DSN = os.getenv("PG_DSN")  # conexión directa a Postgres (opcional) para el camino caliente
 
 
+# === LOGGING ===
+
+# Los registros se escriben desde el hilo del QueueListener: el event loop nunca espera a stderr
+_log_queue: queue.Queue = queue.Queue(-1)
+_log_listener = QueueListener(_log_queue, logging.StreamHandler())
+logging.basicConfig(
+    level=os.getenv("LOG_LEVEL", "INFO"),
+    format="[%(levelname)s] %(message)s",
+    handlers=[QueueHandler(_log_queue)],
+)
+logger = logging.getLogger("dailyhaiku")
+logging.getLogger("httpx").setLevel(logging.WARNING)  # una línea por cada llamada a Supabase es ruido
+
 # === CONFIGURACIÓN ===
 
-app = FastAPI()
+supabase: Optional[AsyncClient] = None
+buttondown: Optional[httpx.AsyncClient] = None  # cliente compartido (HTTP/2) para Buttondown
+pg_pool: Optional[asyncpg.Pool] = None
+
+# Pool keep-alive para PostgREST: reutiliza conexiones TLS entre peticiones
+SUPABASE_HTTP_LIMITS = httpx.Limits(max_connections=50, max_keepalive_connections=20, keepalive_expiry=30)
+
+async def use_pooled_session(client: AsyncClient) -> None:
+    postgrest = client.postgrest
+    await postgrest.session.aclose()
+    postgrest.session = httpx.AsyncClient(
+        base_url=postgrest.base_url,
+        headers=postgrest.headers,
+        timeout=postgrest.timeout,
+        verify=postgrest.verify,
+        proxy=postgrest.proxy,
+        follow_redirects=True,
+        http2=True,
+        limits=SUPABASE_HTTP_LIMITS,
+    )
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global supabase, buttondown, pg_pool
+    _log_listener.start()
+    supabase = await acreate_client(SUPABASE_URL, SUPABASE_KEY)
+    await use_pooled_session(supabase)
+    buttondown = httpx.AsyncClient(
+        base_url="https://api.buttondown.email/v1",
+        headers={"Authorization": f"Token {BUTTONDOWN_API_KEY}"},
+        http2=True,
+        timeout=10.0,
+    )
+    if PG_DSN:
+        # statement_cache_size=0: obligatorio detrás del pooler de Supavisor en modo transacción
+        pg_pool = await asyncpg.create_pool(PG_DSN, min_size=5, max_size=20, statement_cache_size=0)
+    yield
+    if pg_pool is not None:
+        await pg_pool.close()
+    await buttondown.aclose()
+    await supabase.postgrest.aclose()
+    _log_listener.stop()
+
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
+
+# Proxies delante de la app (router de la plataforma, CDN) que añaden su hop a X-Forwarded-For;
+# 0 = sin proxy: X-Forwarded-For se ignora y cuenta la IP del socket
+TRUSTED_PROXY_HOPS = int(os.getenv("TRUSTED_PROXY_HOPS", "1"))
+
+def client_ip(request: Request) -> str:
+    # Cada proxy añade la IP que ve al final; lo que hay a la izquierda lo elige el cliente
+    hops = [hop.strip() for hop in request.headers.get("x-forwarded-for", "").split(",") if hop.strip()]
+    if TRUSTED_PROXY_HOPS <= 0 or not hops:
+        return get_remote_address(request)
+    return hops[-min(TRUSTED_PROXY_HOPS, len(hops))]
+
+# Límite por IP en los endpoints públicos: una ráfaga no agota el pool de Supabase
+limiter = Limiter(key_func=client_ip)
+app.state.limiter = limiter
+app.add_exception_handler(RateLimitExceeded, _rate_limit_exceeded_handler)
 
 BASE_URL = os.getenv("BASE_URL") 
 
-supabase = create_client(SUPABASE_URL, SUPABASE_KEY)
+TZ_CANARIAS = timezone(timedelta(hours=1))  # UTC+1: frontera del día para toda la app
+DATE_PATTERN = r"^\d{4}-\d{2}-\d{2}$"  # YYYY-MM-DD
 
 app.add_middleware(
     CORSMiddleware,
@@ -39,6 +126,7 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(GZipMiddleware, minimum_size=512)  # HTML/JSON de historial comprimen muy bien
 
 # === ESTACIONES DEL AÑO ===
 
@@ -51,78 +139,232 @@ seasons = [
     ('winter', (date(Y, 12, 21), date(Y, 12, 31))),
 ]
 
+# Tabla precalculada: estación de cada día del año bisiesto Y
+SEASON_BY_DOY = tuple(
+    next(season for season, (start, end) in seasons if start <= day <= end)
+    for day in (date(Y, 1, 1) + timedelta(days=i) for i in range(366))
+)
+_MONTH_OFFSET = tuple(date(Y, month, 1).timetuple().tm_yday - 1 for month in range(1, 13))
+
 def get_season(now: date) -> str:
-    now = now.replace(year=Y)
-    return next(season for season, (start, end) in seasons if start <= now <= end)
+    # Indexa por mes/día (no tm_yday) para que los años no bisiestos caigan igual
+    return SEASON_BY_DOY[_MONTH_OFFSET[now.month - 1] + now.day - 1]
+
+# === CACHÉ ===
+
+def seconds_until_midnight(tz: timezone) -> float:
+    now = datetime.now(tz)
+    midnight = datetime.combine(now.date() + timedelta(days=1), time.min, tzinfo=tz)
+    return (midnight - now).total_seconds()
+
+def _by_date_ttu(date_str: str, haiku: dict, now: float) -> float:
+    if date_str < datetime.now(TZ_CANARIAS).date().isoformat():
+        return float("inf")  # el haiku de un día pasado ya no cambia
+    return now + seconds_until_midnight(TZ_CANARIAS)
+
+_haiku_cache = LRUCache(maxsize=4096)  # un haiku publicado (y sus keywords) no cambia
+_by_date_cache = TLRUCache(maxsize=512, ttu=_by_date_ttu)
 
 # === FUNCIONES AUXILIARES ===
 
-def get_haiku_by_id(haiku_id: str) -> Optional[dict]:
-    haiku = supabase.table("haikus").select("*").eq("id", haiku_id).single().execute().data
+# Acota las llamadas simultáneas a PostgREST al tamaño del pool HTTP
+supabase_slots = asyncio.Semaphore(SUPABASE_HTTP_LIMITS.max_connections)
+
+async def run_query(query):
+    async with supabase_slots:
+        return await query.execute()
+
+# haiku + keywords embebidas en una sola petición; ambos embeds fijan la FK
+# para que PostgREST no tenga que adivinarla
+HAIKU_SELECT = "*,keywords!keywords_haiku_id_fkey(keyword)"
+DAILY_HAIKU_EMBED = f"haikus!daily_haikus_haiku_id_fkey({HAIKU_SELECT})"
+
+# Mismas lecturas en SQL nativo, usadas cuando hay pg_pool
+HAIKU_BY_ID_SQL = """
+    SELECT h.*, ARRAY(SELECT k.keyword FROM keywords k WHERE k.haiku_id = h.id) AS keywords
+    FROM haikus h
+    WHERE h.id = $1
+"""
+HAIKU_BY_DATE_SQL = """
+    SELECT h.*, ARRAY(SELECT k.keyword FROM keywords k WHERE k.haiku_id = h.id) AS keywords
+    FROM daily_haikus d
+    JOIN haikus h ON h.id = d.haiku_id
+    WHERE d.date = $1
+"""
+ASSIGN_DAILY_HAIKU_SQL = """
+    SELECT h.*, ARRAY(SELECT k.keyword FROM keywords k WHERE k.haiku_id = h.id) AS keywords
+    FROM assign_daily_haiku($1, $2) h
+"""
+
+def format_haiku(haiku: dict) -> dict:
+    keywords = haiku.pop("keywords", None) or []
+    # PostgREST embebe [{"keyword": ...}]; asyncpg ya devuelve un array de texto
+    haiku["keywords"] = [kw["keyword"] if isinstance(kw, dict) else kw for kw in keywords]
+    return haiku
+
+async def get_haiku_by_id(haiku_id: str) -> Optional[dict]:
+    if haiku_id in _haiku_cache:
+        return _haiku_cache[haiku_id]
+
+    if pg_pool is not None:
+        record = await pg_pool.fetchrow(HAIKU_BY_ID_SQL, int(haiku_id))
+        haiku = dict(record) if record else None
+    else:
+        haiku = (await run_query(supabase.table("haikus").select(HAIKU_SELECT).eq("id", haiku_id).single())).data
     if not haiku:
         return None
 
-    keywords = (
-        supabase.table("keywords")
-        .select("keyword")
-        .eq("haiku_id", haiku_id)
-        .execute()
-    )
-    haiku["keywords"] = [kw["keyword"] for kw in keywords.data] if keywords.data else []
-    haiku["image_url"] = f"{SUPABASE_BUCKET_URL}/haiku_{haiku_id}.png"
+    haiku = format_haiku(haiku)
+    _haiku_cache[haiku_id] = haiku
     return haiku
 
-def get_daily_haiku_by_date(date_str: str) -> Optional[dict]:
+async def get_daily_haiku_by_date(date_str: str) -> Optional[dict]:
+    if date_str in _by_date_cache:
+        return _by_date_cache[date_str]
+
     try:
-        date_obj = datetime.strptime(date_str, "%Y-%m-%d").date()
+        date_obj = date.fromisoformat(date_str)  # solo valida; date_str ya viene en formato ISO
     except ValueError:
         return None
 
-    record = supabase.table("daily_haikus").select("*").eq("date", date_obj.isoformat()).execute()
-    if not record.data:
+    if pg_pool is not None:
+        record = await pg_pool.fetchrow(HAIKU_BY_DATE_SQL, date_obj)
+        haiku = dict(record) if record else None
+    else:
+        record = await run_query(
+            supabase.table("daily_haikus")
+            .select(f"date,haiku_id,{DAILY_HAIKU_EMBED}")
+            .eq("date", date_str)
+            .maybe_single()  # date es único: devuelve el dict o None
+        )
+        haiku = record.data["haikus"] if record else None
+    if not haiku:
         return None
 
-    return get_haiku_by_id(record.data[0]["haiku_id"])
+    haiku = format_haiku(haiku)
+    _haiku_cache[haiku["id"]] = haiku
+    _by_date_cache[date_str] = haiku
+    return haiku
+
+def is_not_modified_since(if_modified_since: Optional[str], last_modified: datetime) -> bool:
+    if not if_modified_since:
+        return False
+    try:
+        since = parsedate_to_datetime(if_modified_since)
+    except (TypeError, ValueError):
+        return False  # fecha no válida: se ignora la cabecera
+    if since.tzinfo is None:
+        since = since.replace(tzinfo=timezone.utc)  # las fechas HTTP van en GMT
+    return since >= last_modified
+
+def conditional_response(
+    request: Request, response: Response, haiku: dict, date_str: str
+) -> Optional[Response]:
+    """
+    Sets ETag, Last-Modified and Cache-Control for the haiku shown on `date_str`.
+    Returns a bodiless 304 when the client's If-None-Match already matches
+    (or, without If-None-Match, when If-Modified-Since is not older than
+    Last-Modified), otherwise None.
+    """
+    if date_str < datetime.now(TZ_CANARIAS).date().isoformat():
+        cache_control = "public, max-age=31536000, immutable"  # un día pasado ya no cambia
+    else:
+        # El de hoy cambia a medianoche: ni el navegador ni la CDN lo sirven más allá
+        until_midnight = int(seconds_until_midnight(TZ_CANARIAS))
+        max_age = min(3600, until_midnight)
+        cache_control = (
+            f"public, max-age={max_age}, s-maxage={max_age}, "
+            f"stale-while-revalidate={until_midnight - max_age}"
+        )
+
+    # Débil: GZipMiddleware sirve el mismo ETag para el cuerpo comprimido y sin comprimir
+    etag = 'W/"' + hashlib.md5(f"{haiku['id']}:{date_str}".encode()).hexdigest() + '"'
+    day_start = datetime.combine(date.fromisoformat(date_str), time.min, tzinfo=TZ_CANARIAS)
+    headers = {
+        "ETag": etag,
+        "Last-Modified": format_datetime(day_start.astimezone(timezone.utc), usegmt=True),
+        "Cache-Control": cache_control,
+    }
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        # Comparación débil (RFC 9110): las CDN debilitan los ETags al comprimir
+        opaque = etag.removeprefix("W/")
+        not_modified = if_none_match.strip() == "*" or opaque in (
+            tag.strip().removeprefix("W/") for tag in if_none_match.split(",")
+        )
+    else:
+        # Solo sin If-None-Match (RFC 9110 §13.2.2): navegadores que revalidan por fecha
+        not_modified = is_not_modified_since(request.headers.get("if-modified-since"), day_start)
+    if not_modified:
+        return Response(status_code=304, headers=headers)
+    response.headers.update(headers)
+    return None
+
+# Asignaciones en curso por fecha: las peticiones simultáneas esperan a la misma
+_inflight: Dict[str, asyncio.Future] = {}
+
+async def get_or_assign_haiku(today: date) -> Optional[dict]:
+    """Returns the haiku for `today`, assigning one if needed; None once all are used."""
+    today_str = today.isoformat()
+    if today_str in _by_date_cache:
+        return _by_date_cache[today_str]
+
+    task = _inflight.get(today_str)
+    if task is None:
+        task = asyncio.ensure_future(assign_haiku(today))
+        _inflight[today_str] = task
+        task.add_done_callback(lambda _: _inflight.pop(today_str, None))
+    # shield: si un cliente se desconecta no cancela la asignación de los demás
+    return await asyncio.shield(task)
+
+async def assign_haiku(today: date) -> Optional[dict]:
+    today_str = today.isoformat()
+    season = get_season(today)
+    # Leer o asignar el haiku de hoy y traerlo con sus keywords, todo en una llamada
+    try:
+        if pg_pool is not None:
+            record = await pg_pool.fetchrow(ASSIGN_DAILY_HAIKU_SQL, today, season)
+            haiku = dict(record) if record else None
+        else:
+            rows = (
+                await run_query(
+                    supabase.rpc("assign_daily_haiku", {"p_date": today_str, "p_season": season})
+                    .select(HAIKU_SELECT)
+                )
+            ).data
+            haiku = rows[0] if rows else None
+    except Exception as e:
+        logger.exception("Failed to assign daily haiku for %s: %s", today_str, e)
+        raise HTTPException(status_code=500, detail="Failed to assign haiku")
+
+    if not haiku:
+        return None
+
+    haiku = format_haiku(haiku)
+    logger.info("Haiku %s assigned for %s", haiku["id"], today_str)
+    _haiku_cache[haiku["id"]] = haiku
+    _by_date_cache[today_str] = haiku
+    return haiku
+
+async def today_date() -> date:
+    return datetime.now(TZ_CANARIAS).date()
 
 # === ENDPOINTS ===
 @app.get("/daily_haiku")
-def get_daily_haiku():
-    tz_offset = timezone(timedelta(hours=1))
-    today = datetime.now(tz_offset).date()
-    today_str = today.strftime("%Y-%m-%d")
-    season = get_season(today)
+@limiter.limit("120/minute")
+async def get_daily_haiku(request: Request, response: Response, today: date = Depends(today_date)):
+    today_str = today.isoformat()
 
-    print(f"[INFO] Generating haiku for {today_str} ({season})")
+    logger.debug("Generating haiku for %s (%s)", today_str, get_season(today))
 
-    # 1. ¿Ya existe uno para hoy?
-    existing = supabase.table("daily_haikus").select("*").eq("date", today_str).execute()
-    if existing.data:
-        haiku = get_haiku_by_id(existing.data[0]["haiku_id"])
-        if haiku:
-            print("[INFO] Haiku already assigned for today.")
-            return haiku
-        else:
-            print("[ERROR] Haiku ID assigned today is invalid.")
-            raise HTTPException(status_code=500, detail="Haiku assigned but not found")
-
-    # 2. Obtener haikus disponibles para la estación
-    used_ids = [
-        row["haiku_id"]
-        for row in supabase.table("daily_haikus").select("haiku_id").execute().data or []
-    ]
-
-    seasonal = supabase.table("haikus").select("*").eq("season", season).execute().data
-    remaining = [h for h in seasonal if h["id"] not in used_ids]
-
-    # 3. Fallback a todos si no quedan de la estación
-    if not remaining:
-        all_haikus = supabase.table("haikus").select("*").execute().data or []
-        remaining = [h for h in all_haikus if h["id"] not in used_ids]
-
-    # 4. Final si no hay ninguno
-    if not remaining:
-        total_days = len(used_ids)
-        print("[INFO] No haikus left. Sending final message.")
+    haiku = await get_or_assign_haiku(today)
+
+    # Final si no queda ninguno
+    if not haiku:
+        total_days = (
+            await run_query(supabase.table("daily_haikus").select("date", count="exact", head=True))
+        ).count or 0
+        logger.info("No haikus left. Sending final message.")
         return {
             "haiku": "The journey has ended.\nEach verse now belongs to you.\nThank you for reading.",
             "author": "DailyHaiku",
@@ -135,28 +377,7 @@ def get_daily_haiku():
             "image_url": f"{SUPABASE_BUCKET_URL}/final_haiku.png"
         }
 
-    # 5. Asignar uno aleatorio
-    chosen = random.choice(remaining)
-
-    if not chosen or "id" not in chosen or not chosen["id"]:
-        print(f"[ERROR] Invalid haiku selected: {chosen}")
-        raise HTTPException(status_code=500, detail="Selected haiku is invalid.")
-
-    try:
-        print(f"[INFO] Inserting haiku {chosen['id']} for {today_str}")
-        result = supabase.table("daily_haikus").upsert({
-            "date": today_str,
-            "haiku_id": int(chosen["id"])
-        }).execute()
-        print(f"[SUCCESS] Insert result: {result}")
-    except Exception as e:
-        import traceback
-        print(f"[ERROR] Failed to insert daily haiku for {today_str}: {e}")
-        traceback.print_exc()
-        raise HTTPException(status_code=500, detail="Failed to insert haiku")
-
-    return get_haiku_by_id(chosen["id"])
-
+    return conditional_response(request, response, haiku, today_str) or haiku
 
 #Redeploy
 
@@ -164,89 +385,155 @@ PAGE_SIZE_DEFAULT = 20
 PAGE_SIZE_MAX = 100   # evita cargas enormes por error
 
 @app.get("/api/haiku/history", response_model=Dict)
-def get_haiku_history(
-    page: int = Query(1, ge=1),
+async def get_haiku_history(
+    response: Response,
+    cursor: Optional[str] = Query(None, pattern=DATE_PATTERN),
     limit: int = Query(PAGE_SIZE_DEFAULT, ge=1, le=PAGE_SIZE_MAX),
 ):
     """
     Returns a paginated list of haikus sorted by date DESC.
     Query params:
-      - page  (int)  : page number, 1‑based
-      - limit (int)  : items per page (max = 100)
+      - cursor (str)  : return haikus strictly before this date (YYYY-MM-DD);
+                        omit for the first page
+      - limit  (int)  : items per page (max = 100)
     Response:
     {
-      "items"   : [ {haiku…}, … ],
-      "nextPage": 2 | null
+      "items"     : [ {haiku…}, … ],
+      "nextCursor": "2025-06-01" | null
     }
     """
-    offset = (page - 1) * limit
-    # 1. Get `date` column for the requested slice
-    rows = (
+    # La CDN cachea cada página (la URL incluye cursor y limit) un minuto
+    response.headers["Cache-Control"] = "public, s-maxage=60"
+    # 1. Get the requested slice with each haiku embedded (single query)
+    # Keyset sobre date en vez de OFFSET: cada página cuesta lo mismo, sin importar su profundidad
+    query = (
         supabase.table("daily_haikus")
-        .select("date")
+        .select(f"date,{DAILY_HAIKU_EMBED}")
         .order("date", desc=True)
-        .range(offset, offset + limit - 1)
-        .execute()
-        .data
+        .limit(limit)
     )
+    if cursor:
+        try:
+            date.fromisoformat(cursor)  # el patrón deja pasar fechas imposibles como 2024-02-30
+        except ValueError:
+            raise HTTPException(status_code=422, detail="Invalid cursor date.")
+        query = query.lt("date", cursor)
+    rows = (await run_query(query)).data
 
     if not rows:
-        # page out of range → empty list & nextPage = null
-        return {"items": [], "nextPage": None}
+        # cursor past the last haiku → empty list & nextCursor = null
+        return {"items": [], "nextCursor": None}
 
     haiku_history: List[Dict] = []
     for row in rows:
-        haiku = get_haiku_data_by_date(row["date"])
-        haiku["date"] = row["date"]
-        haiku_history.append(haiku)
+        if not row["haikus"]:
+            continue
+        haiku = format_haiku(row["haikus"])
+        _haiku_cache[haiku["id"]] = haiku
+        _by_date_cache[row["date"]] = haiku
+        haiku_history.append({**haiku, "date": row["date"]})  # no mutar el dict cacheado
 
     # 2. Decide if there is another page
-    next_page: Optional[int] = page + 1 if len(rows) == limit else None
+    next_cursor: Optional[str] = rows[-1]["date"] if len(rows) == limit else None
 
-    return {"items": haiku_history, "nextPage": next_page}
+    return {"items": haiku_history, "nextCursor": next_cursor}
 
 @app.get("/haiku/today")
-def get_today_haiku():
-    tz_offset = timezone(timedelta(hours=1))  # UTC+1 para Canarias
-    today = datetime.now(tz_offset).strftime("%Y-%m-%d")
-    record = supabase.table("daily_haikus").select("*").eq("date", today).execute()
-
-    if not record.data:
-        raise HTTPException(status_code=404, detail="No haiku assigned for today")
-
-    haiku_id = record.data[0]["haiku_id"]
-    haiku = get_haiku_by_id(haiku_id)
+async def get_today_haiku(request: Request, response: Response, today: date = Depends(today_date)):
+    today_str = today.isoformat()
+    # Cacheado hasta medianoche tras la primera lectura del día
+    haiku = await get_daily_haiku_by_date(today_str)
 
     if not haiku:
-        raise HTTPException(status_code=500, detail="Assigned haiku not found")
+        raise HTTPException(status_code=404, detail="No haiku assigned for today")
 
-    return haiku
+    return conditional_response(request, response, haiku, today_str) or haiku
 
 @app.get("/haiku/{date}")
-def get_haiku_data_by_date(
-    date: str = Path(..., pattern=r"^\d{4}-\d{2}-\d{2}$")  # fuerza formato de fecha YYYY-MM-DD
+@limiter.limit("60/minute")
+async def get_haiku_data_by_date(
+    request: Request,
+    response: Response,
+    date: str = Path(..., pattern=DATE_PATTERN)  # fuerza formato de fecha YYYY-MM-DD
 ):
-    haiku = get_daily_haiku_by_date(date)
+    haiku = await get_daily_haiku_by_date(date)
     if not haiku:
         raise HTTPException(status_code=404, detail="Haiku not found.")
-    return haiku
 
+    return conditional_response(request, response, haiku, date) or haiku
+
+
+@app.post("/internal/assign_daily_haiku")
+async def assign_today_haiku(x_cron_secret: str = Header(...), today: date = Depends(today_date)):
+    """
+    Assigns today's haiku ahead of the first visitor (cron at 00:00 UTC+1)
+    and leaves it in the in-process cache.
+    """
+    if x_cron_secret != os.getenv("CRON_SECRET"):
+        raise HTTPException(status_code=401, detail="Unauthorized")
+
+    haiku = await get_or_assign_haiku(today)
+
+    if not haiku:
+        return {"status": "no haikus left"}
+    return {"status": "assigned", "date": today.isoformat(), "haiku_id": haiku["id"]}
+
+
+def is_retryable(response: httpx.Response) -> bool:
+    # 429 (rate limit) y 5xx son transitorios; el resto no mejora reintentando
+    return response.status_code == 429 or response.status_code >= 500
+
+@retry(
+    retry=retry_if_result(is_retryable) | retry_if_exception_type(httpx.TransportError),
+    wait=wait_exponential(multiplier=1, max=30),
+    stop=stop_after_attempt(5),
+    retry_error_callback=lambda state: state.outcome.result(),  # devuelve la última respuesta
+)
+async def post_email(payload: dict, idempotency_key: str) -> httpx.Response:
+    return await buttondown.post("/emails", json=payload, headers={"Idempotency-Key": idempotency_key})
+
+async def send_email(subject: str, body: str, idempotency_key: str) -> None:
+    try:
+        response = await post_email(
+            {
+                "subject": subject,
+                "body": body,
+                "tags": ["dailyhaiku"],
+                "publish": True
+            },
+            idempotency_key,
+        )
+    except httpx.HTTPError as e:
+        logger.error("Failed to send email: %s", e)
+        return
+
+    if response.status_code == 201:
+        logger.info("Email sent: %s", subject)
+    else:
+        logger.error("Failed to send email (%s): %s", response.status_code, response.text)
 
 @app.post("/send_daily_haiku_email")
-async def trigger_daily_email(x_cron_secret: str = Header(...)):
+async def trigger_daily_email(
+    background_tasks: BackgroundTasks,
+    response: Response,
+    x_cron_secret: str = Header(...),
+    today: date = Depends(today_date),
+):
     if x_cron_secret != os.getenv("CRON_SECRET"):
         raise HTTPException(status_code=401, detail="Unauthorized")
 
-    tz_offset = timezone(timedelta(hours=1))  # UTC+1 para Canarias
-    today = datetime.now(tz_offset).date().isoformat()
-    haiku_record = supabase.table("daily_haikus").select("*").eq("date", today).execute().data
+    today_str = today.isoformat()
+    # Solo hace falta haiku_id; date es único, así que como mucho hay una fila
+    haiku_record = await run_query(
+        supabase.table("daily_haikus").select("haiku_id").eq("date", today_str).maybe_single()
+    )
 
     if not haiku_record:
         return {"status": "no haiku assigned for today"}
 
-    haiku = get_haiku_by_id(haiku_record[0]["haiku_id"])
+    haiku = await get_haiku_by_id(haiku_record.data["haiku_id"])
 
-    subject = f"Haiku for {today}"
+    subject = f"Haiku for {today_str}"
     body = (
     "Hello poetry lover,\n\n"
     f"Here’s your haiku for today:\n\n"
@@ -258,31 +545,8 @@ async def trigger_daily_email(x_cron_secret: str = Header(...)):
     "Sent with 🌸 by DailyHaiku"
 )
 
-
-
-    async with httpx.AsyncClient() as client:
-        response = await client.post(
-            "https://api.buttondown.email/v1/emails",
-            headers={
-                "Authorization": f"Token {BUTTONDOWN_API_KEY}",
-                "Content-Type": "application/json"
-            },
-            json={
-                "subject": subject,
-                "body": body,
-                "tags": ["dailyhaiku"],
-                "publish": True
-            }
-        )
-
-    if response.status_code == 201:
-        return {"status": "email sent"}
-    else:
-        return {
-            "status": "failed",
-            "error": response.status_code,
-            "message": response.text
-        }
-
-
-
+    # El envío sale del request: el cron no espera a Buttondown
+    # Idempotency-Key por día: si el cron se dispara dos veces, Buttondown envía una sola
+    background_tasks.add_task(send_email, subject, body, f"dailyhaiku-{today_str}")
+    response.status_code = 202
+    return {"status": "email queued"}
@@ -0,0 +1,37 @@
+-- Un único haiku por día: respalda el ON CONFLICT de get_or_assign_daily_haiku
+CREATE UNIQUE INDEX IF NOT EXISTS daily_haikus_date_uidx ON daily_haikus (date);
+
+-- Devuelve el haiku asignado al día `d`, asignando uno al azar si aún no existe.
+-- Prefiere haikus sin usar de `p_season` y recurre al resto si no quedan.
+-- Devuelve NULL cuando ya se han usado todos.
+CREATE OR REPLACE FUNCTION get_or_assign_daily_haiku(d date, p_season text)
+RETURNS bigint
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    assigned bigint;
+BEGIN
+    SELECT haiku_id INTO assigned FROM daily_haikus WHERE date = d;
+    IF assigned IS NOT NULL THEN
+        RETURN assigned;
+    END IF;
+
+    SELECT h.id INTO assigned
+    FROM haikus h
+    WHERE NOT EXISTS (SELECT 1 FROM daily_haikus dh WHERE dh.haiku_id = h.id)
+    ORDER BY (h.season = p_season) DESC, random()
+    LIMIT 1;
+
+    IF assigned IS NULL THEN
+        RETURN NULL;
+    END IF;
+
+    INSERT INTO daily_haikus (date, haiku_id)
+    VALUES (d, assigned)
+    ON CONFLICT (date) DO NOTHING;
+
+    -- Si otra petición asignó el día antes, devolver el que quedó guardado
+    SELECT haiku_id INTO assigned FROM daily_haikus WHERE date = d;
+    RETURN assigned;
+END;
+$$;
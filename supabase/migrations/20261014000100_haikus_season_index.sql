@@ -0,0 +1,2 @@
+-- Respalda el WHERE season = p_season de random_unused_haiku (siguiente migración)
+CREATE INDEX IF NOT EXISTS haikus_season_idx ON haikus (season);
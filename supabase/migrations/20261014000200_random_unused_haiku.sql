@@ -0,0 +1,57 @@
+-- Un haiku al azar que aún no se haya asignado, de `p_season` si quedan;
+-- si no, de cualquier estación. Vacío cuando ya se han usado todos.
+CREATE OR REPLACE FUNCTION random_unused_haiku(p_season text)
+RETURNS SETOF haikus
+LANGUAGE plpgsql
+VOLATILE  -- random(): dos llamadas con el mismo p_season no devuelven lo mismo
+AS $$
+BEGIN
+    -- Primero solo la estación (usa haikus_season_idx)
+    RETURN QUERY
+        SELECT h.*
+        FROM haikus h
+        WHERE h.season = p_season
+          AND NOT EXISTS (SELECT 1 FROM daily_haikus dh WHERE dh.haiku_id = h.id)
+        ORDER BY random()
+        LIMIT 1;
+    IF FOUND THEN
+        RETURN;
+    END IF;
+
+    -- No quedan de la estación: cualquiera sin usar
+    RETURN QUERY
+        SELECT h.*
+        FROM haikus h
+        WHERE NOT EXISTS (SELECT 1 FROM daily_haikus dh WHERE dh.haiku_id = h.id)
+        ORDER BY random()
+        LIMIT 1;
+END;
+$$;
+
+-- get_or_assign_daily_haiku pasa a delegar la elección en random_unused_haiku
+CREATE OR REPLACE FUNCTION get_or_assign_daily_haiku(d date, p_season text)
+RETURNS bigint
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    assigned bigint;
+BEGIN
+    SELECT haiku_id INTO assigned FROM daily_haikus WHERE date = d;
+    IF assigned IS NOT NULL THEN
+        RETURN assigned;
+    END IF;
+
+    SELECT id INTO assigned FROM random_unused_haiku(p_season);
+    IF assigned IS NULL THEN
+        RETURN NULL;
+    END IF;
+
+    INSERT INTO daily_haikus (date, haiku_id)
+    VALUES (d, assigned)
+    ON CONFLICT (date) DO NOTHING;
+
+    -- Si otra petición asignó el día antes, devolver el que quedó guardado
+    SELECT haiku_id INTO assigned FROM daily_haikus WHERE date = d;
+    RETURN assigned;
+END;
+$$;
@@ -0,0 +1,42 @@
+-- La URL de la imagen se guarda en la fila en lugar de formatearla en cada petición.
+-- Necesita la URL pública del bucket (la misma que SUPABASE_BUCKET_URL):
+--   ALTER DATABASE postgres SET app.bucket_url = 'https://<proyecto>.supabase.co/storage/v1/object/public/<bucket>';
+ALTER TABLE haikus ADD COLUMN IF NOT EXISTS image_url text;
+
+-- Lee app.bucket_url y falla con un mensaje claro si no está configurada
+CREATE OR REPLACE FUNCTION haiku_bucket_url()
+RETURNS text
+LANGUAGE plpgsql
+STABLE
+AS $$
+DECLARE
+    bucket_url text := nullif(current_setting('app.bucket_url', true), '');
+BEGIN
+    IF bucket_url IS NULL THEN
+        RAISE EXCEPTION 'app.bucket_url is not set'
+            USING HINT = 'ALTER DATABASE postgres SET app.bucket_url = ''<SUPABASE_BUCKET_URL>'' and reconnect.';
+    END IF;
+    RETURN bucket_url;
+END;
+$$;
+
+CREATE OR REPLACE FUNCTION set_haiku_image_url()
+RETURNS trigger
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    IF NEW.image_url IS NULL THEN
+        NEW.image_url := haiku_bucket_url() || '/haiku_' || NEW.id || '.png';
+    END IF;
+    RETURN NEW;
+END;
+$$;
+
+DROP TRIGGER IF EXISTS haikus_set_image_url ON haikus;
+CREATE TRIGGER haikus_set_image_url
+    BEFORE INSERT ON haikus
+    FOR EACH ROW EXECUTE FUNCTION set_haiku_image_url();
+
+UPDATE haikus
+SET image_url = haiku_bucket_url() || '/haiku_' || id || '.png'
+WHERE image_url IS NULL;
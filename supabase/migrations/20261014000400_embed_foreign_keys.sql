@@ -0,0 +1,33 @@
+-- Las selects embebidas (daily_haikus -> haikus -> keywords) fijan estas FKs por nombre.
+-- Se buscan por tabla y columna, no por nombre: si ya existe una FK haiku_id -> haikus
+-- con otro nombre se renombra (añadir otra haría ambiguo el embed, PGRST201).
+DO $$
+DECLARE
+    tbl text;
+    fk name;
+    existing name;
+BEGIN
+    FOREACH tbl IN ARRAY ARRAY['daily_haikus', 'keywords'] LOOP
+        fk := tbl || '_haiku_id_fkey';
+
+        SELECT c.conname INTO existing
+        FROM pg_constraint c
+        JOIN pg_attribute a ON a.attrelid = c.conrelid AND a.attname = 'haiku_id'
+        WHERE c.contype = 'f'
+          AND c.conrelid = tbl::regclass
+          AND c.confrelid = 'haikus'::regclass
+          AND c.conkey = ARRAY[a.attnum]
+        ORDER BY c.conname = fk DESC
+        LIMIT 1;
+
+        IF existing IS NULL THEN
+            EXECUTE format(
+                'ALTER TABLE %I ADD CONSTRAINT %I FOREIGN KEY (haiku_id) REFERENCES haikus (id)',
+                tbl, fk
+            );
+        ELSIF existing <> fk THEN
+            EXECUTE format('ALTER TABLE %I RENAME CONSTRAINT %I TO %I', tbl, existing, fk);
+        END IF;
+    END LOOP;
+END;
+$$;
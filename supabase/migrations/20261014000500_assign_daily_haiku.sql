@@ -0,0 +1,14 @@
+-- Igual que get_or_assign_daily_haiku, pero devuelve la fila completa del haiku.
+-- Al devolver SETOF haikus, PostgREST puede embeber keywords sobre el resultado
+-- (rpc(...).select(HAIKU_SELECT)): asignar y leer es una sola petición.
+CREATE OR REPLACE FUNCTION assign_daily_haiku(p_date date, p_season text)
+RETURNS SETOF haikus
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    assigned bigint;
+BEGIN
+    assigned := get_or_assign_daily_haiku(p_date, p_season);
+    RETURN QUERY SELECT h.* FROM haikus h WHERE h.id = assigned;
+END;
+$$;
@@ -0,0 +1,34 @@
+-- Cada haiku se publica como mucho un día; también sirve de índice para el anti-join
+CREATE UNIQUE INDEX IF NOT EXISTS daily_haikus_haiku_id_uidx ON daily_haikus (haiku_id);
+
+-- Con haiku_id único, dos días asignados a la vez pueden elegir el mismo haiku:
+-- el INSERT de uno no hace nada y vuelve a elegir.
+CREATE OR REPLACE FUNCTION get_or_assign_daily_haiku(d date, p_season text)
+RETURNS bigint
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    assigned bigint;
+    max_attempts CONSTANT int := 10;
+BEGIN
+    FOR attempt IN 1..max_attempts LOOP
+        -- FOUND y no assigned: una fila del día con haiku_id NULL también termina
+        SELECT haiku_id INTO assigned FROM daily_haikus WHERE date = d;
+        IF FOUND THEN
+            RETURN assigned;
+        END IF;
+
+        SELECT id INTO assigned FROM random_unused_haiku(p_season);
+        IF assigned IS NULL THEN
+            RETURN NULL;
+        END IF;
+
+        -- Sin columna de conflicto: ignora tanto el mismo día como un haiku ya usado
+        INSERT INTO daily_haikus (date, haiku_id)
+        VALUES (d, assigned)
+        ON CONFLICT DO NOTHING;
+    END LOOP;
+
+    RAISE EXCEPTION 'could not assign a haiku to % after % attempts', d, max_attempts;
+END;
+$$;
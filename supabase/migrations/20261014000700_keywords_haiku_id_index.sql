@@ -0,0 +1,2 @@
+-- Las keywords se leen siempre por haiku (select embebida y ARRAY(...) en asyncpg)
+CREATE INDEX IF NOT EXISTS keywords_haiku_id_idx ON keywords (haiku_id);